@@ -8,7 +8,8 @@ Features:
 - Users: browse main/sub buttons, view service details (name/price/desc/image),
          order a service (collect data fields defined by admin), pay from balance,
          top-up via simulated external flow, view orders, cancel pending orders,
-         receive notifications when balance changed or order status changed.
+         receive notifications when balance changed or order status changed,
+         search services by name/description (/search or inline mode: @bot query).
 DB: SQLite (file: store_bot.db)
 Library: pyTelegramBotAPI
 All UI uses InlineKeyboardButtons (callbacks).
@@ -16,9 +17,15 @@ All UI uses InlineKeyboardButtons (callbacks).
 
 import sqlite3
 import os
+import logging
 import json
 import time
-from datetime import datetime
+import re
+import threading
+from collections import OrderedDict
+import queue
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from functools import wraps
 import telebot
 from telebot import types
@@ -29,9 +36,68 @@ from telebot import types
 BOT_TOKEN = "REPLACE_WITH_BOT_TOKEN"
 ADMIN_ID = 123456789  # استبدل برقم آي دي الأدمن (رقمي)
 DB_PATH = "store_bot.db"
+SEARCH_RESULTS_LIMIT = 10     # max results for /search and inline mode
+SEARCH_CACHE_TTL = 60         # seconds a cached search result stays valid
+SEARCH_CACHE_SIZE = 256       # max cached query prefixes
+DEDUP_WINDOW = 3              # seconds a repeated (user, callback data) tap is ignored
+CALLBACK_ID_TTL = 600         # seconds a processed callback query id is remembered
+WATERMARK_MAX_AGE_DAYS = 7    # Telegram restarts update_id at a random value after a week without updates
+DEDUP_CACHE_SIZE = 5000       # purge expired dedup keys above this size
+ORDER_TTL_HOURS = 24          # balance-paid pending orders older than this are cancelled and refunded
+EXTERNAL_ORDER_TTL_HOURS = 2  # unpaid external-payment orders older than this are expired
+FLOW_TTL_MINUTES = 15         # abandoned multi-step flows (pending dict) are dropped after this
+SCHEDULER_BATCH = 50          # rows per write transaction in scheduled jobs
+SCHEDULER_BATCH_PAUSE = 0.2   # seconds between batches so handlers get the write lock
+NOTIFY_RATE = 20              # max notification messages per second
+BACKUP_DIR = "backups"        # online snapshots of DB_PATH
+BACKUP_KEEP = 7               # number of snapshots kept, oldest are deleted
+BACKUP_INTERVAL_HOURS = 24    # scheduled backup interval
+HANDLER_WORKERS = 4           # threads running handlers (replaces telebot's worker pool)
+HANDLER_QUEUES = {            # priority class: (queue size, scheduling weight)
+    "admin": (100, 4),
+    "purchase": (200, 2),
+    "browse": (300, 1),
+}
 # ==========================
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+class StoreBot(telebot.TeleBot):
+    """TeleBot that drops replayed updates, persists the last received update_id
+    and hands each update to the priority queues instead of running it directly.
+
+    The watermark is written once updates are queued, not when their handlers finish:
+    Telegram already considers them delivered at that point, so updates still queued
+    when the process dies are lost rather than replayed (at-most-once, never a double charge).
+
+    The restored watermark only seeds the getUpdates offset. The first batch after startup
+    is taken as-is and resets the watermark, because update ids may have restarted lower."""
+
+    first_batch = True
+
+    def process_new_updates(self, updates):
+        if not updates:
+            return
+        if self.first_batch:
+            self.first_batch = False
+            fresh = updates
+            self.last_update_id = max(u.update_id for u in updates)
+        else:
+            watermark = self.last_update_id
+            fresh = [u for u in updates if u.update_id > watermark]
+        if not fresh:
+            return
+        for update in fresh:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            enqueue_update(update)
+        set_setting("last_received_update", f"{self.last_update_id}:{int(time.time())}")
+
+    def run_update(self, update):
+        super().process_new_updates([update])
+
+logger = logging.getLogger("store_bot")
+
+# threaded=False: handlers run inline on the handler worker that dequeued the update
+bot = StoreBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
 
 # --------------- Utilities & DB ----------------
 
@@ -39,27 +105,30 @@ def ensure_db():
     """Create tables if not exist"""
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
-    # users: id (text), balance (real), banned (int), created_at
+    # WAL (persistent in the file): readers, e.g. a running backup, never block writers
+    cur.execute("PRAGMA journal_mode=WAL")
+    # users: id (telegram id, rowid alias), balance_cents (int, USD cents), banned (int), created_at
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
-        id TEXT PRIMARY KEY,
-        balance REAL DEFAULT 0,
+        id INTEGER PRIMARY KEY,
+        balance_cents INTEGER NOT NULL DEFAULT 0,
         banned INTEGER DEFAULT 0,
         created_at TEXT
     )""")
     # main buttons (categories)
     cur.execute("""
     CREATE TABLE IF NOT EXISTS main_buttons (
-        name TEXT PRIMARY KEY,
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
         image TEXT
     )""")
     # sub buttons mapping to service_id
     cur.execute("""
     CREATE TABLE IF NOT EXISTS sub_buttons (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
-        main_name TEXT,
+        main_id INTEGER NOT NULL REFERENCES main_buttons(id) ON DELETE CASCADE,
         sub_name TEXT,
-        service_id INTEGER
+        service_id INTEGER NOT NULL REFERENCES services(id) ON DELETE CASCADE
     )""")
     # services
     cur.execute("""
@@ -70,8 +139,20 @@ def ensure_db():
         price_usd REAL DEFAULT 0,
         image TEXT,
         enabled INTEGER DEFAULT 1,
-        collect_fields TEXT  -- JSON list of field names to ask user
+        collect_fields TEXT  -- JSON form schema: list of field names or {name,type,regex,min_len,max_len,choices}
     )""")
+    # full-text index over services (rowid = services.id), synced by the service wrappers
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS services_fts USING fts5(
+        name,
+        description,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )""")
+    # backfill services created before the index existed
+    cur.execute("""
+    INSERT INTO services_fts(rowid,name,description)
+    SELECT id,name,description FROM services
+    WHERE id NOT IN (SELECT rowid FROM services_fts)""")
     # orders
     cur.execute("""
     CREATE TABLE IF NOT EXISTS orders (
@@ -80,9 +161,14 @@ def ensure_db():
         service_id INTEGER,
         data TEXT,        -- JSON of collected data
         price REAL,
-        status TEXT,      -- pending, processing, completed, rejected, cancelled
-        created_at TEXT
+        status TEXT,      -- pending, processing, completed, rejected, cancelled, expired
+        created_at TEXT,
+        payment TEXT      -- balance, external (NULL for orders created before this was tracked)
     )""")
+    cur.execute("PRAGMA table_info(orders)")
+    if "payment" not in [r[1] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE orders ADD COLUMN payment TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)")
     # settings
     cur.execute("""
     CREATE TABLE IF NOT EXISTS settings (
@@ -90,6 +176,11 @@ def ensure_db():
         value TEXT
     )""")
     conn.commit()
+    migrate_users(conn)
+    migrate_catalog(conn)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sub_buttons_main ON sub_buttons(main_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sub_buttons_service ON sub_buttons(service_id)")
+    conn.commit()
     conn.close()
     # seed default settings if not present
     set_default_setting("welcome", "مرحباً! أهلاً بك في متجر الشحن. اختر من القائمة.")
@@ -97,8 +188,66 @@ def ensure_db():
     set_default_setting("accepting_orders", "1")
     set_default_setting("maintenance", "0")
 
+def migrate_users(conn):
+    """Move users from TEXT ids / REAL balances to INTEGER ids / integer cents.
+    Rows whose id is not a plain number cannot belong to a Telegram user and are dropped."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(users)")]
+    if "balance_cents" in cols:
+        return
+    conn.executescript("""
+    BEGIN;
+    CREATE TABLE users_new (
+        id INTEGER PRIMARY KEY,
+        balance_cents INTEGER NOT NULL DEFAULT 0,
+        banned INTEGER DEFAULT 0,
+        created_at TEXT
+    );
+    INSERT INTO users_new(id,balance_cents,banned,created_at)
+        SELECT CAST(id AS INTEGER), CAST(ROUND(SUM(COALESCE(balance,0)) * 100) AS INTEGER), MAX(banned), MIN(created_at)
+        FROM users
+        WHERE id GLOB '[0-9]*' AND id NOT GLOB '*[^0-9]*'
+        GROUP BY CAST(id AS INTEGER);
+    DROP TABLE users;
+    ALTER TABLE users_new RENAME TO users;
+    COMMIT;
+    """)
+
+def migrate_catalog(conn):
+    """Move a name-keyed catalog (main_buttons.name PK, sub_buttons.main_name) to integer ids with FKs.
+    Sub buttons pointing at a missing main button or service are dropped."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(main_buttons)")]
+    if "id" in cols:
+        return
+    conn.execute("PRAGMA foreign_keys = OFF")
+    conn.executescript("""
+    BEGIN;
+    CREATE TABLE main_buttons_new (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        image TEXT
+    );
+    INSERT INTO main_buttons_new(name,image) SELECT name,image FROM main_buttons ORDER BY rowid;
+    CREATE TABLE sub_buttons_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        main_id INTEGER NOT NULL REFERENCES main_buttons(id) ON DELETE CASCADE,
+        sub_name TEXT,
+        service_id INTEGER NOT NULL REFERENCES services(id) ON DELETE CASCADE
+    );
+    INSERT INTO sub_buttons_new(id,main_id,sub_name,service_id)
+        SELECT s.id, m.id, s.sub_name, s.service_id
+        FROM sub_buttons s JOIN main_buttons_new m ON m.name = s.main_name
+        WHERE s.service_id IN (SELECT id FROM services);
+    DROP TABLE sub_buttons;
+    DROP TABLE main_buttons;
+    ALTER TABLE main_buttons_new RENAME TO main_buttons;
+    ALTER TABLE sub_buttons_new RENAME TO sub_buttons;
+    COMMIT;
+    """)
+
 def db_conn():
-    return sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
 
 def set_default_setting(key, value):
     conn = db_conn(); cur = conn.cursor()
@@ -135,60 +284,68 @@ def admin_only(func):
         return func(message, *args, **kwargs)
     return wrapper
 
+def to_cents(amount):
+    """USD amount (str/float/int) -> integer cents, rounded half up"""
+    try:
+        return int((Decimal(str(amount).strip()) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f"invalid amount: {amount}")
+
+def fmt_money(cents):
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
 def user_exists_create(uid):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT id FROM users WHERE id = ?", (str(uid),))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO users(id,balance,banned,created_at) VALUES(?,?,?,?)",
-                    (str(uid), 0.0, 0, datetime.utcnow().isoformat()))
-        conn.commit()
-    conn.close()
+    cur.execute("INSERT OR IGNORE INTO users(id,balance_cents,banned,created_at) VALUES(?,?,?,?)",
+                (int(uid), 0, 0, datetime.utcnow().isoformat()))
+    conn.commit(); conn.close()
 
 def is_banned(uid):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT banned FROM users WHERE id = ?", (str(uid),))
+    cur.execute("SELECT banned FROM users WHERE id = ?", (int(uid),))
     r = cur.fetchone()
     conn.close()
     return r and r[0] == 1
 
 def get_balance(uid):
+    """Balance in cents"""
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT balance FROM users WHERE id = ?", (str(uid),))
+    cur.execute("SELECT balance_cents FROM users WHERE id = ?", (int(uid),))
     r = cur.fetchone(); conn.close()
-    return r[0] if r else 0.0
+    return r[0] if r else 0
 
-def set_balance(uid, amount):
+def set_balance(uid, cents):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("UPDATE users SET balance = ? WHERE id = ?", (float(amount), str(uid)))
+    cur.execute("UPDATE users SET balance_cents = ? WHERE id = ?", (int(cents), int(uid)))
     conn.commit(); conn.close()
 
-def add_balance(uid, amount):
+def add_balance(uid, cents):
+    """Add cents (creating the user if needed); returns the new balance in cents"""
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT balance FROM users WHERE id = ?", (str(uid),))
-    r = cur.fetchone()
-    if not r:
-        cur.execute("INSERT INTO users(id,balance,banned,created_at) VALUES(?,?,?,?)",
-                    (str(uid), float(amount), 0, datetime.utcnow().isoformat()))
-        conn.commit()
-        conn.close()
-        return float(amount)
-    new = round(r[0] + float(amount), 2)
-    cur.execute("UPDATE users SET balance = ? WHERE id = ?", (new, str(uid)))
+    cur.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE id = ?", (int(cents), int(uid)))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO users(id,balance_cents,banned,created_at) VALUES(?,?,?,?)",
+                    (int(uid), int(cents), 0, datetime.utcnow().isoformat()))
+    cur.execute("SELECT balance_cents FROM users WHERE id = ?", (int(uid),))
+    new = cur.fetchone()[0]
     conn.commit(); conn.close()
     return new
 
-def deduct_balance(uid, amount):
+def deduct_balance(uid, cents):
+    """Deduct cents if the balance covers it; returns (True, new balance in cents) or (False, message)"""
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT balance FROM users WHERE id = ?", (str(uid),))
+    cur.execute("UPDATE users SET balance_cents = balance_cents - ? WHERE id = ? AND balance_cents >= ?",
+                (int(cents), int(uid), int(cents)))
+    deducted = cur.rowcount == 1
+    cur.execute("SELECT balance_cents FROM users WHERE id = ?", (int(uid),))
     r = cur.fetchone()
-    if not r:
-        conn.close(); return False, "المستخدم غير موجود"
-    if r[0] < float(amount) - 1e-9:
-        conn.close(); return False, "رصيد غير كافٍ"
-    new = round(r[0] - float(amount), 2)
-    cur.execute("UPDATE users SET balance = ? WHERE id = ?", (new, str(uid)))
     conn.commit(); conn.close()
-    return True, new
+    if not r:
+        return False, "المستخدم غير موجود"
+    if not deducted:
+        return False, "رصيد غير كافٍ"
+    return True, r[0]
 
 # --------------- Admin actions (DB wrappers) ----------------
 
@@ -203,18 +360,34 @@ def add_main_button(name, image=None):
         conn.close()
 
 def remove_main_button(name):
+    # sub buttons go with it (ON DELETE CASCADE)
     conn = db_conn(); cur = conn.cursor()
     cur.execute("DELETE FROM main_buttons WHERE name = ?", (name,))
     conn.commit(); conn.close()
     return True, "تم الحذف." 
 
+def rename_main_button(old_name, new_name):
+    conn = db_conn(); cur = conn.cursor()
+    try:
+        cur.execute("UPDATE main_buttons SET name = ? WHERE name = ?", (new_name, old_name))
+        conn.commit()
+        if cur.rowcount == 0:
+            return False, "لا يوجد زر رئيسي بهذا الاسم."
+        return True, "تمت إعادة التسمية."
+    except sqlite3.IntegrityError:
+        return False, "الاسم الجديد مستخدم مسبقاً."
+    finally:
+        conn.close()
+
 def add_service(name, description, price_usd, image=None, collect_fields=None):
     conn = db_conn(); cur = conn.cursor()
     cf_json = json.dumps(collect_fields or [], ensure_ascii=False)
     cur.execute("INSERT INTO services(name,description,price_usd,image,enabled,collect_fields) VALUES(?,?,?,?,1,?)",
                 (name, description, float(price_usd), image, cf_json))
     sid = cur.lastrowid
+    fts_index_service(cur, sid, name, description)
     conn.commit(); conn.close()
+    search_cache_clear()
     return sid
 
 def edit_service(sid, name=None, description=None, price_usd=None, image=None, enabled=None, collect_fields=None):
@@ -224,6 +397,11 @@ def edit_service(sid, name=None, description=None, price_usd=None, image=None, e
     if not r:
         conn.close(); return False, "الخدمة غير موجودة."
     cur_name, cur_desc, cur_price, cur_image, cur_enabled, cur_cf = r[1], r[2], r[3], r[4], r[5], r[6]
+    if collect_fields is not None:
+        try:
+            compile_form(collect_fields)
+        except FORM_ERRORS as e:
+            conn.close(); return False, f"حقول غير صالحة: {e}"
     new_name = name if name is not None else cur_name
     new_desc = description if description is not None else cur_desc
     new_price = float(price_usd) if price_usd is not None else cur_price
@@ -232,35 +410,208 @@ def edit_service(sid, name=None, description=None, price_usd=None, image=None, e
     new_cf = json.dumps(collect_fields, ensure_ascii=False) if collect_fields is not None else cur_cf
     cur.execute("""UPDATE services SET name=?,description=?,price_usd=?,image=?,enabled=?,collect_fields=? WHERE id=?""",
                 (new_name,new_desc,new_price,new_image,new_enabled,new_cf,sid))
+    fts_index_service(cur, sid, new_name, new_desc)
     conn.commit(); conn.close()
+    search_cache_clear()
+    form_cache_drop(sid)
     return True, "تم تعديل الخدمة."
 
 def remove_service(sid):
     conn = db_conn(); cur = conn.cursor()
+    # linked sub buttons go with it (ON DELETE CASCADE)
     cur.execute("DELETE FROM services WHERE id = ?", (sid,))
-    cur.execute("DELETE FROM sub_buttons WHERE service_id = ?", (sid,))
+    cur.execute("DELETE FROM services_fts WHERE rowid = ?", (sid,))
     conn.commit(); conn.close()
+    search_cache_clear()
+    form_cache_drop(sid)
     return True, "تم حذف الخدمة."
 
 def add_sub_button(main_name, sub_name, service_id):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("INSERT INTO sub_buttons(main_name,sub_name,service_id) VALUES(?,?,?)", (main_name, sub_name, service_id))
+    cur.execute("INSERT INTO sub_buttons(main_id,sub_name,service_id) SELECT id,?,? FROM main_buttons WHERE name = ?",
+                (sub_name, service_id, main_name))
     conn.commit(); conn.close()
+    if cur.rowcount == 0:
+        return False, "لا يوجد زر رئيسي بهذا الاسم."
     return True, "تم إضافة زر فرعي مرتبط بالخدمة."
 
 def remove_sub_button_by_name(main_name, sub_name):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("DELETE FROM sub_buttons WHERE main_name = ? AND sub_name = ?", (main_name, sub_name))
+    cur.execute("DELETE FROM sub_buttons WHERE main_id = (SELECT id FROM main_buttons WHERE name = ?) AND sub_name = ?",
+                (main_name, sub_name))
     conn.commit(); conn.close()
     return True, "تم حذف الزر الفرعي."
 
+# --------------- Search (FTS5) ----------------
+# services_fts mirrors services.name/description; rowid is the service id.
+# Results are cached per normalized query prefix and dropped on any catalog change.
+
+search_cache = OrderedDict()  # {normalized_query: (expires_at, rows)}
+search_cache_lock = threading.Lock()
+
+def fts_index_service(cur, sid, name, description):
+    """(Re)index one service inside the caller's transaction"""
+    cur.execute("DELETE FROM services_fts WHERE rowid = ?", (sid,))
+    cur.execute("INSERT INTO services_fts(rowid,name,description) VALUES(?,?,?)", (sid, name or "", description or ""))
+
+def search_cache_clear():
+    with search_cache_lock:
+        search_cache.clear()
+
+def search_terms(query):
+    return [t.lower() for t in re.findall(r"\w+", query or "")]
+
+def search_services(query):
+    """Return up to SEARCH_RESULTS_LIMIT enabled services matching query, best match first:
+    [(id,name,description,price_usd,image)]"""
+    terms = search_terms(query)
+    if not terms:
+        return []
+    key = " ".join(terms)
+    now = time.time()
+    with search_cache_lock:
+        hit = search_cache.get(key)
+        if hit and hit[0] > now:
+            search_cache.move_to_end(key)
+            return hit[1]
+    # every term is matched as a prefix so results show up while the user is typing
+    match = " ".join(f'"{t}"*' for t in terms)
+    conn = db_conn(); cur = conn.cursor()
+    cur.execute("""SELECT s.id,s.name,s.description,s.price_usd,s.image
+                   FROM services_fts f JOIN services s ON s.id = f.rowid
+                   WHERE services_fts MATCH ? AND s.enabled = 1
+                   ORDER BY bm25(services_fts) LIMIT ?""", (match, SEARCH_RESULTS_LIMIT))
+    rows = cur.fetchall(); conn.close()
+    with search_cache_lock:
+        search_cache[key] = (now + SEARCH_CACHE_TTL, rows)
+        search_cache.move_to_end(key)
+        while len(search_cache) > SEARCH_CACHE_SIZE:
+            search_cache.popitem(last=False)
+    return rows
+
+# --------------- Order forms ----------------
+# services.collect_fields is a form schema. Each entry is either a plain field name (free text)
+# or {"name", "label", "type", "regex", "min_len", "max_len", "choices"}.
+# Schemas are compiled once per service and recompiled only when the stored JSON changes.
+
+FIELD_PATTERNS = {
+    "text": None,
+    "number": r"\d+",
+    "phone": r"\+?\d{7,15}",
+    "email": r"[^@\s]+@[^@\s]+\.[^@\s]+",
+    "choice": None,
+}
+FIELD_HINTS = {
+    "number": "أرقام فقط",
+    "phone": "رقم هاتف، مثال: +9665xxxxxxxx",
+    "email": "بريد إلكتروني",
+}
+FIELD_MAX_LEN = 256
+
+form_cache = {}  # {service_id: (collect_fields_json, compiled_fields)}
+form_cache_lock = threading.Lock()
+
+def compile_field(spec):
+    if isinstance(spec, str):
+        spec = {"name": spec}
+    name = str(spec["name"]).strip()
+    if not name:
+        raise ValueError("اسم الحقل فارغ")
+    choices = [str(ch) for ch in spec.get("choices") or []]
+    ftype = "choice" if choices else spec.get("type") or "text"
+    if ftype not in FIELD_PATTERNS:
+        raise ValueError(f"نوع حقل غير معروف: {ftype}")
+    if ftype == "choice" and not choices:
+        raise ValueError(f"الحقل {name} بدون خيارات")
+    pattern = spec.get("regex") or FIELD_PATTERNS[ftype]
+    try:
+        regex = re.compile(pattern) if pattern else None
+    except re.error as e:
+        raise ValueError(f"تعبير غير صالح للحقل {name}: {e}")
+    return {
+        "name": name,
+        "label": spec.get("label") or name,
+        "type": ftype,
+        "regex": regex,
+        "min_len": int(spec["min_len"]) if spec.get("min_len") is not None else 1,
+        "max_len": int(spec["max_len"]) if spec.get("max_len") is not None else FIELD_MAX_LEN,
+        "choices": choices,
+    }
+
+FORM_ERRORS = (ValueError, TypeError, KeyError)  # what a malformed schema can raise
+
+def compile_form(specs):
+    # the old editor stored "id,phone," as ["id","phone",""]; blank plain names are skipped
+    return [compile_field(spec) for spec in specs or [] if not (isinstance(spec, str) and not spec.strip())]
+
+def get_service_form(sid, cf_json):
+    """Compiled fields for a service; cf_json is the stored collect_fields and acts as the version"""
+    with form_cache_lock:
+        hit = form_cache.get(sid)
+    if hit and hit[0] == cf_json:
+        return hit[1]
+    fields = compile_form(json.loads(cf_json or "[]"))
+    with form_cache_lock:
+        form_cache[sid] = (cf_json, fields)
+    return fields
+
+def form_cache_drop(sid):
+    with form_cache_lock:
+        form_cache.pop(sid, None)
+
+def validate_field(field, value):
+    """Return (True, clean_value) or (False, error message)"""
+    value = (value or "").strip()
+    if field["choices"]:
+        if value not in field["choices"]:
+            return False, "اختر إحدى القيم: " + " / ".join(field["choices"])
+        return True, value
+    if len(value) < field["min_len"] or len(value) > field["max_len"]:
+        return False, f"طول القيمة يجب أن يكون بين {field['min_len']} و {field['max_len']} حرفاً."
+    if field["regex"] and not field["regex"].fullmatch(value):
+        hint = FIELD_HINTS.get(field["type"])
+        return False, "صيغة غير صالحة." + (f" ({hint})" if hint else "")
+    return True, value
+
+def parse_fields_spec(text):
+    """Admin input -> schema list. Accepts a JSON list, or comma-separated entries:
+    name | name:type | name:type:min-max | name:choice=a/b/c"""
+    text = (text or "").strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        specs = json.loads(text)
+    else:
+        specs = []
+        for part in text.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            name, _, rest = part.partition(":")
+            spec = {"name": name.strip()}
+            rest = rest.strip()
+            if rest.startswith("choice="):
+                spec["type"] = "choice"
+                spec["choices"] = [ch.strip() for ch in rest[len("choice="):].split("/") if ch.strip()]
+            elif rest:
+                ftype, _, length = rest.partition(":")
+                spec["type"] = ftype.strip()
+                if length:
+                    lo, _, hi = length.partition("-")
+                    spec["min_len"] = int(lo)
+                    if hi:
+                        spec["max_len"] = int(hi)
+            specs.append(spec)
+    compile_form(specs)  # raises ValueError on a bad schema
+    return specs
+
 # --------------- Orders ----------------
 
-def create_order(user_id, service_id, data_dict, price):
+def create_order(user_id, service_id, data_dict, price, payment="balance"):
     conn = db_conn(); cur = conn.cursor()
     now = datetime.utcnow().isoformat()
-    cur.execute("INSERT INTO orders(user_id,service_id,data,price,status,created_at) VALUES(?,?,?,?,?,?)",
-                (str(user_id), int(service_id), json.dumps(data_dict, ensure_ascii=False), float(price), "pending", now))
+    cur.execute("INSERT INTO orders(user_id,service_id,data,price,status,created_at,payment) VALUES(?,?,?,?,?,?,?)",
+                (str(user_id), int(service_id), json.dumps(data_dict, ensure_ascii=False), float(price), "pending", now, payment))
     oid = cur.lastrowid
     conn.commit(); conn.close()
     return oid
@@ -271,6 +622,23 @@ def set_order_status(oid, status):
     conn.commit(); conn.close()
     return True
 
+def resolve_order(oid, status):
+    """Admin decision on a pending order (completed/rejected). A rejected balance-paid order is
+    refunded in the same transaction. Returns (True, (user_id, price, refunded)) or (False, message)"""
+    conn = db_conn(); cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("UPDATE orders SET status = ? WHERE id = ? AND status = 'pending'", (status, int(oid)))
+    if cur.rowcount != 1:
+        conn.rollback(); conn.close()
+        return False, "الطلب غير موجود أو تمت معالجته مسبقاً."
+    cur.execute("SELECT user_id,price,payment FROM orders WHERE id = ?", (int(oid),))
+    user_id, price, payment = cur.fetchone()
+    refunded = status == "rejected" and payment == "balance"
+    if refunded:
+        cur.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE id = ?", (to_cents(price), int(user_id)))
+    conn.commit(); conn.close()
+    return True, (user_id, price, refunded)
+
 def get_order(oid):
     conn = db_conn(); cur = conn.cursor()
     cur.execute("SELECT id,user_id,service_id,data,price,status,created_at FROM orders WHERE id = ?", (int(oid),))
@@ -281,23 +649,23 @@ def get_order(oid):
 
 def mk_main_menu():
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT name FROM main_buttons")
+    cur.execute("SELECT id,name FROM main_buttons ORDER BY id")
     rows = cur.fetchall(); conn.close()
     kb = types.InlineKeyboardMarkup(row_width=2)
-    for r in rows:
-        kb.add(types.InlineKeyboardButton(r[0], callback_data=f"main:{r[0]}"))
+    for mid, name in rows:
+        kb.add(types.InlineKeyboardButton(name, callback_data=f"m:{mid}"))
     kb.add(types.InlineKeyboardButton("رصيدي 💰", callback_data="my_balance"))
     kb.add(types.InlineKeyboardButton("سجل الطلبات 📜", callback_data="my_orders"))
     kb.add(types.InlineKeyboardButton("الشروط 📜", callback_data="show_terms"))
     return kb
 
-def mk_sub_menu(main_name):
+def mk_sub_menu(main_id):
     conn = db_conn(); cur = conn.cursor()
-    cur.execute("SELECT sub_name,service_id FROM sub_buttons WHERE main_name = ?", (main_name,))
+    cur.execute("SELECT sub_name,service_id FROM sub_buttons WHERE main_id = ? ORDER BY id", (main_id,))
     rows = cur.fetchall(); conn.close()
     kb = types.InlineKeyboardMarkup(row_width=1)
     for sub_name, sid in rows:
-        kb.add(types.InlineKeyboardButton(sub_name, callback_data=f"service:{sid}"))
+        kb.add(types.InlineKeyboardButton(sub_name, callback_data=f"s:{sid}"))
     kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
     return kb
 
@@ -308,10 +676,29 @@ def mk_service_kb(sid):
     kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
     return kb
 
+def mk_search_kb(rows):
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    for sid, name, _desc, price, _img in rows:
+        kb.add(types.InlineKeyboardButton(f"{name} - {fmt_money(to_cents(price))}$", callback_data=f"s:{sid}"))
+    kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
+    return kb
+
+def mk_choice_kb(step, field):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(*[types.InlineKeyboardButton(ch, callback_data=f"fc:{step}:{i}") for i, ch in enumerate(field["choices"])])
+    return kb
+
+def mk_order_admin_kb(oid):
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(types.InlineKeyboardButton("✅ تم التنفيذ", callback_data=f"ord:done:{oid}"),
+           types.InlineKeyboardButton("❌ رفض", callback_data=f"ord:rej:{oid}"))
+    return kb
+
 def mk_admin_kb():
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(types.InlineKeyboardButton("➕ إضافة زر رئيسي", callback_data="adm:add_main"))
     kb.add(types.InlineKeyboardButton("➖ حذف زر رئيسي", callback_data="adm:del_main"))
+    kb.add(types.InlineKeyboardButton("✏️ إعادة تسمية زر رئيسي", callback_data="adm:rename_main"))
     kb.add(types.InlineKeyboardButton("➕ إضافة زر فرعي", callback_data="adm:add_sub"))
     kb.add(types.InlineKeyboardButton("➖ حذف زر فرعي", callback_data="adm:del_sub"))
     kb.add(types.InlineKeyboardButton("🛠 إدارة خدمة (تعديل/سعر/صورة)", callback_data="adm:edit_service"))
@@ -320,6 +707,8 @@ def mk_admin_kb():
     kb.add(types.InlineKeyboardButton("📣 إرسال إعلان جماعي", callback_data="adm:broadcast"))
     kb.add(types.InlineKeyboardButton("🔒 قفل/فتح خدمة", callback_data="adm:toggle_service"))
     kb.add(types.InlineKeyboardButton("🛰 صيانة (تشغيل/إيقاف)", callback_data="adm:maintenance"))
+    kb.add(types.InlineKeyboardButton("💾 نسخة احتياطية الآن", callback_data="adm:backup"))
+    kb.add(types.InlineKeyboardButton("📊 إحصائيات الطوابير", callback_data="adm:metrics"))
     return kb
 
 # --------------- State Management for multi-step flows --------------
@@ -329,6 +718,7 @@ def mk_admin_kb():
 pending = {}  # {user_id: {"action": str, ...}}
 
 def set_pending(uid, obj):
+    obj["ts"] = time.time()
     pending[str(uid)] = obj
 
 def get_pending(uid):
@@ -337,9 +727,366 @@ def get_pending(uid):
 def pop_pending(uid):
     return pending.pop(str(uid), None)
 
+# --------------- Update dedup --------------
+# Replays after a restart are dropped by StoreBot using the persisted received update_id watermark.
+# Double taps and redelivered callbacks are caught here: a callback query id is handled once,
+# and the same (user, callback data) - e.g. buy_bal:<sid> - is ignored within DEDUP_WINDOW.
+
+recent_keys = {}  # {key: expires_at}
+recent_keys_lock = threading.Lock()
+
+def seen_recently(key, ttl):
+    """Return True if key was seen within its ttl, otherwise remember it and return False"""
+    now = time.time()
+    with recent_keys_lock:
+        if len(recent_keys) > DEDUP_CACHE_SIZE:
+            for k in [k for k, exp in recent_keys.items() if exp <= now]:
+                del recent_keys[k]
+        exp = recent_keys.get(key)
+        if exp and exp > now:
+            return True
+        recent_keys[key] = now + ttl
+        return False
+
+def is_duplicate_callback(c):
+    if seen_recently(("cq", c.id), CALLBACK_ID_TTL):
+        return True
+    return seen_recently(("act", c.from_user.id, c.data or ""), DEDUP_WINDOW)
+
+def load_update_watermark():
+    """Restore the update_id watermark unless it is old enough that Telegram may have reset ids"""
+    update_id, _, saved_at = (get_setting("last_received_update") or "0:0").partition(":")
+    if time.time() - int(saved_at or 0) > WATERMARK_MAX_AGE_DAYS * 86400:
+        bot.last_update_id = 0
+        return
+    bot.last_update_id = int(update_id)
+
+# --------------- Handler scheduling --------------
+# Updates are classified (admin > purchase/collect flows > browsing), put on bounded per-class
+# queues and run by HANDLER_WORKERS threads using weighted round-robin, so browsing floods
+# cannot delay payments or admin actions. A full browse queue answers callbacks with "busy"
+# right away; full admin/purchase queues block the polling thread (backpressure on getUpdates).
+
+PURCHASE_CALLBACKS = ("buy_bal:", "payext:", "fc:")
+PURCHASE_COMMANDS = ("/buy_ext", "/topup_ext")
+
+handler_queues = {cls: queue.Queue(maxsize=size) for cls, (size, _) in HANDLER_QUEUES.items()}
+handler_items = threading.Semaphore(0)  # one permit per queued update
+handler_schedule = [cls for rnd in range(max(w for _, w in HANDLER_QUEUES.values()))
+                    for cls, (_, w) in HANDLER_QUEUES.items() if rnd < w]
+handler_sched_pos = [0]
+queue_stats = {cls: {"processed": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0} for cls in HANDLER_QUEUES}
+queue_stats_lock = threading.Lock()
+
+def update_priority(update):
+    if update.callback_query:
+        c = update.callback_query
+        if c.from_user.id == ADMIN_ID:
+            return "admin"
+        return "purchase" if (c.data or "").startswith(PURCHASE_CALLBACKS) else "browse"
+    if update.message and update.message.from_user:
+        m = update.message
+        if m.from_user.id == ADMIN_ID:
+            return "admin"
+        pending_obj = get_pending(m.from_user.id)
+        if (pending_obj and pending_obj.get("action") in COLLECT_ACTIONS) or (m.text or "").startswith(PURCHASE_COMMANDS):
+            return "purchase"
+    return "browse"
+
+def enqueue_update(update):
+    cls = update_priority(update)
+    item = (time.time(), update)
+    if cls == "browse":
+        try:
+            handler_queues[cls].put_nowait(item)
+        except queue.Full:
+            reject_busy(update)
+            return
+    else:
+        handler_queues[cls].put(item)
+    handler_items.release()
+
+def reject_busy(update):
+    with queue_stats_lock:
+        queue_stats["browse"]["rejected"] += 1
+    busy = "⏳ البوت مشغول حالياً، حاول مرة أخرى."
+    try:
+        if update.callback_query:
+            bot.answer_callback_query(update.callback_query.id, busy)
+        elif update.inline_query:
+            bot.answer_inline_query(update.inline_query.id, [], cache_time=0, is_personal=True)
+        elif update.message:
+            bot.send_message(update.message.chat.id, busy)
+    except:
+        pass
+
+def next_update():
+    """Block until an update is queued; the scheduled class goes first, then strict priority"""
+    handler_items.acquire()
+    with queue_stats_lock:
+        preferred = handler_schedule[handler_sched_pos[0]]
+        handler_sched_pos[0] = (handler_sched_pos[0] + 1) % len(handler_schedule)
+    order = [preferred] + [cls for cls in HANDLER_QUEUES if cls != preferred]
+    while True:
+        for cls in order:
+            try:
+                queued_at, update = handler_queues[cls].get_nowait()
+            except queue.Empty:
+                continue
+            wait = time.time() - queued_at
+            with queue_stats_lock:
+                st = queue_stats[cls]
+                st["processed"] += 1; st["wait_total"] += wait; st["wait_max"] = max(st["wait_max"], wait)
+            return update
+
+def handler_worker():
+    while True:
+        update = next_update()
+        try:
+            bot.run_update(update)
+        except Exception:
+            # with threaded=False telebot has already offered the error to bot.exception_handler;
+            # what reaches here was not handled there
+            logger.exception("update %s failed", update.update_id)
+
+def start_handler_workers():
+    for i in range(HANDLER_WORKERS):
+        threading.Thread(target=handler_worker, name=f"handler-{i}", daemon=True).start()
+
+def queue_metrics_text():
+    lines = ["📊 طوابير المعالجة:"]
+    with queue_stats_lock:
+        for cls, st in queue_stats.items():
+            avg = st["wait_total"] / st["processed"] * 1000 if st["processed"] else 0.0
+            lines.append(f"{cls}: بالانتظار {handler_queues[cls].qsize()} | تمت {st['processed']} | مرفوضة {st['rejected']} "
+                         f"| متوسط الانتظار {avg:.0f}ms | الأقصى {st['wait_max'] * 1000:.0f}ms")
+    return "\n".join(lines)
+
+# --------------- Notifier --------------
+# Scheduled jobs queue user notifications here; flush_notifications() merges messages per user
+# and sends them at NOTIFY_RATE so a large expiry run does not hit Telegram's flood limits.
+
+notify_queue = queue.Queue()
+
+def notify(uid, text):
+    notify_queue.put((uid, text))
+
+def flush_notifications():
+    grouped = OrderedDict()
+    while True:
+        try:
+            uid, text = notify_queue.get_nowait()
+        except queue.Empty:
+            break
+        grouped.setdefault(uid, []).append(text)
+    sent = 0
+    for uid, texts in grouped.items():
+        try:
+            bot.send_message(int(uid), "\n".join(texts))
+            sent += 1
+        except Exception:
+            pass
+        time.sleep(1.0 / NOTIFY_RATE)
+    return sent
+
+# --------------- Scheduler --------------
+# A single daemon thread runs periodic jobs. Jobs touch at most SCHEDULER_BATCH rows per
+# transaction and pause between batches, so the write lock is never held for long.
+
+def expire_orders_batch(payment, cutoff, new_status, refund):
+    """Move one batch of stale pending orders to new_status (refunding if asked). Returns affected orders"""
+    conn = db_conn(); cur = conn.cursor()
+    cur.execute("SELECT id,user_id,price FROM orders WHERE status = 'pending' AND payment = ? AND created_at < ? ORDER BY id LIMIT ?",
+                (payment, cutoff, SCHEDULER_BATCH))
+    rows = cur.fetchall()
+    done = []
+    if rows:
+        cur.execute("BEGIN IMMEDIATE")
+        for oid, user_id, price in rows:
+            # re-check status inside the transaction: the admin may have handled it meanwhile
+            cur.execute("UPDATE orders SET status = ? WHERE id = ? AND status = 'pending'", (new_status, oid))
+            if cur.rowcount != 1:
+                continue
+            if refund:
+                cur.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE id = ?", (to_cents(price), int(user_id)))
+            done.append((oid, user_id, price))
+        conn.commit()
+    conn.close()
+    return len(rows), done
+
+def expire_orders(payment, ttl_hours, new_status, refund, message):
+    cutoff = (datetime.utcnow() - timedelta(hours=ttl_hours)).isoformat()
+    scanned = expired = 0
+    while True:
+        n, done = expire_orders_batch(payment, cutoff, new_status, refund)
+        scanned += n; expired += len(done)
+        for oid, user_id, price in done:
+            notify(user_id, message.format(oid=oid, price=fmt_money(to_cents(price))))
+        if n < SCHEDULER_BATCH:
+            break
+        time.sleep(SCHEDULER_BATCH_PAUSE)
+    return {"scanned": scanned, "expired": expired}
+
+def job_cancel_stale_orders():
+    return expire_orders("balance", ORDER_TTL_HOURS, "cancelled", True,
+                         "⌛ تم إلغاء طلبك #{oid} تلقائياً لعدم معالجته، وتمت إعادة {price}$ إلى رصيدك.")
+
+def job_expire_external_orders():
+    return expire_orders("external", EXTERNAL_ORDER_TTL_HOURS, "expired", False,
+                         "⌛ انتهت مهلة الدفع للطلب الخارجي #{oid} وتم إلغاؤه.")
+
+def job_expire_flows():
+    cutoff = time.time() - FLOW_TTL_MINUTES * 60
+    expired = 0
+    for key, obj in list(pending.items()):
+        if obj.get("ts", 0) < cutoff and pending.pop(key, None) is not None:
+            expired += 1
+            if obj.get("action") in COLLECT_ACTIONS:
+                notify(key, "⌛ انتهت مهلة إدخال بيانات الطلب. ابدأ من جديد عند الحاجة.")
+    return {"expired": expired}
+
+# --------------- Backups --------------
+# Snapshots use SQLite's online backup API in a single step, i.e. one read transaction:
+# a stepped backup restarts from page 0 whenever the bot writes, and may never finish on a
+# busy bot. Under WAL that read transaction does not block writers.
+# Backups run on their own thread so a slow copy never delays the scheduler jobs.
+# The snapshot is written to a .part file, checked with PRAGMA integrity_check on its own
+# connection (never the live DB) and only then renamed into place and rotated.
+
+backup_lock = threading.Lock()
+
+def fmt_size(n):
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024.0
+    return f"{n:.1f}GB"
+
+def rotate_backups():
+    files = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("store_bot-") and f.endswith(".db"))
+    removed = 0
+    for f in files[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(BACKUP_DIR, f))
+        removed += 1
+    return removed
+
+def backup_db():
+    """Take a verified online snapshot. Returns a result dict, or None if a backup is already running"""
+    if not backup_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.time()
+        try:
+            os.makedirs(BACKUP_DIR, exist_ok=True)
+        except OSError as e:
+            return {"file": None, "size": 0, "duration": 0.0, "error": str(e)}
+        path = os.path.join(BACKUP_DIR, datetime.utcnow().strftime("store_bot-%Y%m%d-%H%M%S.db"))
+        tmp = path + ".part"
+        try:
+            src = db_conn(); dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst, pages=-1)
+            finally:
+                dst.close(); src.close()
+            chk = sqlite3.connect(tmp)
+            try:
+                integrity = chk.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                chk.close()
+            size = os.path.getsize(tmp)
+            if integrity != "ok":
+                os.remove(tmp)
+                return {"file": None, "size": size, "duration": round(time.time() - started, 3), "error": f"integrity_check: {integrity}"}
+            os.replace(tmp, path)
+        except (sqlite3.Error, OSError) as e:
+            # disk full, permissions...: never leave a half-written snapshot behind
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return {"file": None, "size": 0, "duration": round(time.time() - started, 3), "error": str(e)}
+        try:
+            rotated = rotate_backups()
+        except OSError:
+            rotated = 0
+        return {"file": path, "size": size, "duration": round(time.time() - started, 3), "integrity": integrity, "rotated": rotated}
+    finally:
+        backup_lock.release()
+
+def job_backup():
+    return backup_db() or {"skipped": "already running"}
+
+def admin_backup(uid):
+    res = backup_db()
+    if res is None:
+        bot.send_message(uid, "⏳ هناك نسخة احتياطية قيد التنفيذ حالياً.")
+        return
+    if not res["file"]:
+        bot.send_message(uid, f"❌ فشل إنشاء النسخة الاحتياطية: {res['error']}")
+        return
+    bot.send_message(uid, f"✅ تم إنشاء نسخة احتياطية: {os.path.basename(res['file'])}\n"
+                          f"الحجم: {fmt_size(res['size'])}\nالمدة: {res['duration']} ثانية\n"
+                          f"تم حذف {res['rotated']} نسخة قديمة.")
+
+SCHEDULED_JOBS = [
+    # (name, function, interval seconds)
+    ("cancel_stale_orders", job_cancel_stale_orders, 300),
+    ("expire_external_orders", job_expire_external_orders, 300),
+    ("expire_flows", job_expire_flows, 60),
+]
+job_stats = {}  # {name: {"last_run": iso, "duration": seconds, "counts": dict}}
+scheduler_stop = threading.Event()
+
+def run_job(name, func):
+    started = time.time()
+    try:
+        counts = func()
+    except Exception as e:
+        counts = {"error": str(e)}
+    sent = flush_notifications()
+    duration = round(time.time() - started, 3)
+    job_stats[name] = {"last_run": datetime.utcnow().isoformat(), "duration": duration, "counts": counts, "notified": sent}
+    # quiet runs (nothing touched, nothing sent) are only kept in job_stats
+    if "error" in counts:
+        logger.error("scheduler %s: %s notified=%s in %ss", name, counts, sent, duration)
+    elif sent or any(isinstance(v, (int, float)) and v for v in counts.values()):
+        logger.info("scheduler %s: %s notified=%s in %ss", name, counts, sent, duration)
+    return job_stats[name]
+
+def scheduler_loop():
+    next_run = {name: 0 for name, _, _ in SCHEDULED_JOBS}
+    while not scheduler_stop.is_set():
+        for name, func, interval in SCHEDULED_JOBS:
+            if time.time() >= next_run[name]:
+                run_job(name, func)
+                next_run[name] = time.time() + interval
+        scheduler_stop.wait(1)
+
+def next_backup_due():
+    """The newest snapshot + BACKUP_INTERVAL_HOURS, so restarts do not add extra snapshots"""
+    try:
+        files = [os.path.join(BACKUP_DIR, f) for f in os.listdir(BACKUP_DIR) if f.startswith("store_bot-") and f.endswith(".db")]
+    except OSError:
+        files = []
+    if not files:
+        return time.time()
+    return max(os.path.getmtime(f) for f in files) + BACKUP_INTERVAL_HOURS * 3600
+
+def backup_loop():
+    due = next_backup_due()
+    while not scheduler_stop.wait(max(0, min(due - time.time(), 60))):
+        if time.time() >= due:
+            run_job("backup", job_backup)
+            due = time.time() + BACKUP_INTERVAL_HOURS * 3600
+
+def start_scheduler():
+    t = threading.Thread(target=scheduler_loop, name="scheduler", daemon=True)
+    t.start()
+    threading.Thread(target=backup_loop, name="backup", daemon=True).start()
+    return t
+
 # --------------- Bot Handlers ----------------
 
 ensure_db()
+load_update_watermark()
 
 @bot.message_handler(commands=['start'])
 def cmd_start(m):
@@ -365,18 +1112,139 @@ def cmd_admin(m):
 def cmd_myid(m):
     bot.reply_to(m, f"Your id: {m.from_user.id}")
 
+@bot.message_handler(commands=['search'])
+def cmd_search(m):
+    uid = m.from_user.id
+    if get_setting("maintenance") == "1" and uid != ADMIN_ID:
+        bot.reply_to(m, "⚠️ البوت في وضع الصيانة.")
+        return
+    if is_banned(uid):
+        bot.send_message(m.chat.id, "🚫 أنت محظور من استخدام البوت.")
+        return
+    query = (m.text or "").split(maxsplit=1)[1:]
+    if not query:
+        bot.reply_to(m, "استخدم: /search <كلمة البحث>")
+        return
+    rows = search_services(query[0])
+    if not rows:
+        bot.send_message(m.chat.id, "لا توجد نتائج مطابقة.")
+        return
+    bot.send_message(m.chat.id, f"نتائج البحث ({len(rows)}):", reply_markup=mk_search_kb(rows))
+
+# --------------- Order form collection ----------------
+# Shared by purchase_collect (pay from balance) and buyext_collect (external payment).
+
+COLLECT_ACTIONS = ("purchase_collect", "buyext_collect")
+
+def prompt_field(uid, pending_obj):
+    step = pending_obj["step"]
+    field = pending_obj["fields"][step]
+    if field["choices"]:
+        bot.send_message(uid, f"اختر قيمة الحقل: {field['label']}", reply_markup=mk_choice_kb(step, field))
+        return
+    hint = FIELD_HINTS.get(field["type"])
+    bot.send_message(uid, f"أرسل قيمة الحقل التالي: {field['label']}" + (f" ({hint})" if hint else ""))
+
+def collect_field_value(uid, pending_obj, value):
+    """Validate and store the answer for the current field, re-prompting on bad input.
+    Returns True once every field is collected."""
+    field = pending_obj["fields"][pending_obj["step"]]
+    ok, res = validate_field(field, value)
+    if not ok:
+        bot.send_message(uid, f"❌ {res}")
+        prompt_field(uid, pending_obj)
+        return False
+    pending_obj["collected"][field["name"]] = res
+    pending_obj["step"] += 1
+    if pending_obj["step"] < len(pending_obj["fields"]):
+        set_pending(uid, pending_obj)
+        prompt_field(uid, pending_obj)
+        return False
+    return True
+
+def finish_collect(uid, pending_obj):
+    sid = pending_obj["sid"]; price = pending_obj["price"]; collected = pending_obj["collected"]
+    pop_pending(uid)
+    if pending_obj["action"] == "purchase_collect":
+        # deduct balance and create order
+        ok,res = deduct_balance(uid, to_cents(price))
+        if not ok:
+            bot.send_message(uid, f"فشل في خصم الرصيد: {res}")
+            return
+        oid = create_order(uid, sid, collected, price)
+        bot.send_message(uid, f"✅ تم إنشاء الطلب #{oid}. رصيدك الآن {fmt_money(res)}$")
+        bot.send_message(ADMIN_ID, f"طلب جديد #{oid} من {uid} بقيمة {fmt_money(to_cents(price))}$", reply_markup=mk_order_admin_kb(oid))
+        return
+    # external payment: create order and simulate external payment accepted
+    oid = create_order(uid, sid, collected, price, payment="external")
+    # Here we assume external payment processed; admin should verify in real integration.
+    bot.send_message(uid, f"✅ تم إنشاء الطلب الخارجي #{oid}. سيتم إكماله بعد الدفع (محاكاة).")
+    bot.send_message(ADMIN_ID, f"[دفع خارجي] طلب جديد #{oid} من {uid} بقيمة {fmt_money(to_cents(price))}$", reply_markup=mk_order_admin_kb(oid))
+
+# --------------- Inline mode (@bot query) ----------------
+
+@bot.inline_handler(func=lambda q: True)
+def on_inline_query(q):
+    uid = q.from_user.id
+    if (get_setting("maintenance") == "1" and uid != ADMIN_ID) or is_banned(uid):
+        bot.answer_inline_query(q.id, [], cache_time=SEARCH_CACHE_TTL, is_personal=True)
+        return
+    results = []
+    for sid, name, desc, price, img in search_services(q.query):
+        text = f"<b>{name}</b>\nالسعر: {fmt_money(to_cents(price))}$\n{desc}"
+        results.append(types.InlineQueryResultArticle(
+            id=str(sid), title=name,
+            input_message_content=types.InputTextMessageContent(text, parse_mode="HTML"),
+            reply_markup=mk_service_kb(sid),
+            description=f"{fmt_money(to_cents(price))}$ - {(desc or '')[:60]}"))
+    bot.answer_inline_query(q.id, results, cache_time=SEARCH_CACHE_TTL)
+
 # --------------- Callback Query Handling ----------------
 
 @bot.callback_query_handler(func=lambda c: True)
 def on_callback(c):
     data = c.data or ""
     uid = c.from_user.id
+    # replayed callback or double tap: acknowledge without touching the DB
+    if is_duplicate_callback(c):
+        try:
+            bot.answer_callback_query(c.id)
+        except:
+            pass
+        return
     # maintenance check
     if get_setting("maintenance") == "1" and uid != ADMIN_ID:
         bot.answer_callback_query(c.id, "البوت في وضع الصيانة.")
         return
 
     # Admin flows
+    # admin decision on a new order: ord:done:<oid> / ord:rej:<oid>
+    if data.startswith("ord:"):
+        if uid != ADMIN_ID:
+            bot.answer_callback_query(c.id, "غير مسموح.")
+            return
+        _, decision, oid = data.split(":", 2)
+        status = "completed" if decision == "done" else "rejected"
+        ok, res = resolve_order(int(oid), status)
+        if not ok:
+            bot.answer_callback_query(c.id, res)
+            return
+        user_id, price, refunded = res
+        try:
+            bot.edit_message_reply_markup(c.message.chat.id, c.message.message_id, reply_markup=None)
+        except:
+            pass
+        if status == "completed":
+            note = f"✅ تم تنفيذ طلبك #{oid}."
+        else:
+            note = f"❌ تم رفض طلبك #{oid}." + (f" تمت إعادة {fmt_money(to_cents(price))}$ إلى رصيدك." if refunded else "")
+        try:
+            bot.send_message(int(user_id), note)
+        except:
+            pass
+        bot.answer_callback_query(c.id, f"الطلب #{oid}: {status}")
+        return
+
     if data.startswith("adm:"):
         if uid != ADMIN_ID:
             bot.answer_callback_query(c.id, "غير مسموح.")
@@ -392,6 +1260,11 @@ def on_callback(c):
             set_pending(uid, {"action":"adm_del_main"})
             bot.answer_callback_query(c.id)
             return
+        if action == "rename_main":
+            bot.send_message(uid, "أرسل: <الاسم الحالي>|<الاسم الجديد>")
+            set_pending(uid, {"action":"adm_rename_main"})
+            bot.answer_callback_query(c.id)
+            return
         if action == "add_sub":
             bot.send_message(uid, "أرسل اسم الزر الرئيسي الذي تود إضافة فرعي إليه:")
             set_pending(uid, {"action":"adm_add_sub_step","step":1})
@@ -427,6 +1300,15 @@ def on_callback(c):
             set_pending(uid, {"action":"adm_toggle_service"})
             bot.answer_callback_query(c.id)
             return
+        if action == "backup":
+            # runs off the handler thread; the admin gets a message when the snapshot is verified
+            threading.Thread(target=admin_backup, args=(uid,), name="admin-backup", daemon=True).start()
+            bot.answer_callback_query(c.id, "جاري إنشاء نسخة احتياطية...")
+            return
+        if action == "metrics":
+            bot.send_message(uid, queue_metrics_text())
+            bot.answer_callback_query(c.id)
+            return
         if action == "maintenance":
             cur = get_setting("maintenance")
             new = "0" if cur == "1" else "1"
@@ -438,7 +1320,7 @@ def on_callback(c):
     # User menu callbacks
     if data == "my_balance":
         bal = get_balance(uid)
-        bot.answer_callback_query(c.id, f"رصيدك الحالي: {bal}$")
+        bot.answer_callback_query(c.id, f"رصيدك الحالي: {fmt_money(bal)}$")
         return
     if data == "my_orders":
         conn = db_conn(); cur = conn.cursor()
@@ -448,7 +1330,7 @@ def on_callback(c):
             bot.send_message(uid, "لا توجد طلبات لديك.")
             bot.answer_callback_query(c.id)
             return
-        text = "سجل طلباتك:\n" + "\n".join([f"#{r[0]} - {r[1]} - {r[2]}$ - {r[3][:19]}" for r in rows])
+        text = "سجل طلباتك:\n" + "\n".join([f"#{r[0]} - {r[1]} - {fmt_money(to_cents(r[2]))}$ - {r[3][:19]}" for r in rows])
         bot.send_message(uid, text)
         bot.answer_callback_query(c.id)
         return
@@ -462,13 +1344,24 @@ def on_callback(c):
         bot.answer_callback_query(c.id)
         return
 
-    if data.startswith("main:"):
-        main_name = data.split(":",1)[1]
-        bot.send_message(uid, f"القسم: {main_name}", reply_markup=mk_sub_menu(main_name))
+    # m:<main id>; main:<name> is still accepted from keyboards sent before ids existed
+    if data.startswith("m:") or data.startswith("main:"):
+        key = data.split(":",1)[1]
+        conn = db_conn(); cur = conn.cursor()
+        if data.startswith("m:"):
+            cur.execute("SELECT id,name FROM main_buttons WHERE id = ?", (int(key),))
+        else:
+            cur.execute("SELECT id,name FROM main_buttons WHERE name = ?", (key,))
+        r = cur.fetchone(); conn.close()
+        if not r:
+            bot.answer_callback_query(c.id, "القسم غير موجود.")
+            return
+        bot.send_message(uid, f"القسم: {r[1]}", reply_markup=mk_sub_menu(r[0]))
         bot.answer_callback_query(c.id)
         return
 
-    if data.startswith("service:"):
+    # s:<service id>; service:<id> is the pre-compact form
+    if data.startswith("s:") or data.startswith("service:"):
         sid = int(data.split(":",1)[1])
         conn = db_conn(); cur = conn.cursor()
         cur.execute("SELECT id,name,description,price_usd,image,enabled,collect_fields FROM services WHERE id = ?", (sid,))
@@ -479,8 +1372,8 @@ def on_callback(c):
         if r[5] == 0:
             bot.answer_callback_query(c.id, "هذه الخدمة مغلقة مؤقتاً.")
             return
-        name = r[1]; desc = r[2]; price = r[3]; img = r[4]; cf = json.loads(r[6] or "[]")
-        text = f"<b>{name}</b>\nالسعر: {price}$\n{desc}"
+        name = r[1]; desc = r[2]; price = r[3]; img = r[4]
+        text = f"<b>{name}</b>\nالسعر: {fmt_money(to_cents(price))}$\n{desc}"
         if img:
             try:
                 bot.send_photo(uid, img, caption=text, reply_markup=mk_service_kb(sid))
@@ -500,26 +1393,45 @@ def on_callback(c):
         if not r:
             bot.answer_callback_query(c.id, "الخدمة غير موجودة.")
             return
-        price = float(r[0]); collect_fields = json.loads(r[1] or "[]")
-        if get_balance(uid) < price:
+        price = float(r[0])
+        try:
+            collect_fields = get_service_form(sid, r[1])
+        except FORM_ERRORS:
+            bot.answer_callback_query(c.id, "نموذج بيانات هذه الخدمة غير صالح. تواصل مع الإدارة.")
+            return
+        if get_balance(uid) < to_cents(price):
             bot.answer_callback_query(c.id, "رصيدك غير كافٍ. اشحن رصيدك.")
             return
         # begin collect fields if necessary
         if collect_fields:
             # store pending purchase state
-            set_pending(uid, {"action":"purchase_collect","sid":sid,"price":price,"fields":collect_fields,"collected":{}, "step":0})
-            bot.send_message(uid, f"أرسل قيمة الحقل التالي: {collect_fields[0]}")
+            pending_obj = {"action":"purchase_collect","sid":sid,"price":price,"fields":collect_fields,"collected":{}, "step":0}
+            set_pending(uid, pending_obj)
+            prompt_field(uid, pending_obj)
             bot.answer_callback_query(c.id)
             return
         # else directly deduct & create order
-        ok, res = deduct_balance(uid, price)
+        ok, res = deduct_balance(uid, to_cents(price))
         if not ok:
             bot.answer_callback_query(c.id, res)
             return
         oid = create_order(uid, sid, {}, price)
         bot.answer_callback_query(c.id, "تم سحب المبلغ وإنشاء الطلب. سيتم إبلاغك بتحديث الحالة.")
-        bot.send_message(ADMIN_ID, f"طلب جديد #{oid} من {uid} بقيمة {price}$")
-        bot.send_message(uid, f"✅ تم إنشاء الطلب #{oid}. رصيدك الآن {get_balance(uid)}$")
+        bot.send_message(ADMIN_ID, f"طلب جديد #{oid} من {uid} بقيمة {fmt_money(to_cents(price))}$", reply_markup=mk_order_admin_kb(oid))
+        bot.send_message(uid, f"✅ تم إنشاء الطلب #{oid}. رصيدك الآن {fmt_money(res)}$")
+        return
+
+    if data.startswith("fc:"):
+        # choice field answered from inline buttons: fc:<step>:<choice index>
+        _, step, idx = data.split(":", 2)
+        pending_obj = get_pending(uid)
+        if not pending_obj or pending_obj.get("action") not in COLLECT_ACTIONS or pending_obj["step"] != int(step):
+            bot.answer_callback_query(c.id, "انتهت صلاحية هذا الاختيار.")
+            return
+        choices = pending_obj["fields"][pending_obj["step"]]["choices"]
+        bot.answer_callback_query(c.id)
+        if collect_field_value(uid, pending_obj, choices[int(idx)]):
+            finish_collect(uid, pending_obj)
         return
 
     if data.startswith("payext:"):
@@ -601,9 +1513,17 @@ def all_text(m):
                 # create service
                 sid = add_service(pending_obj["svc_name"], pending_obj["svc_desc"], price)
                 # link sub button
-                add_sub_button(pending_obj["main_name"], pending_obj["sub_name"], sid)
-                bot.send_message(uid, f"تم إنشاء الخدمة برقم {sid} وربطها بالزر الفرعي.")
+                ok, msg = add_sub_button(pending_obj["main_name"], pending_obj["sub_name"], sid)
+                bot.send_message(uid, f"تم إنشاء الخدمة برقم {sid} وربطها بالزر الفرعي." if ok else msg)
                 pop_pending(uid); return
+        if action == "adm_rename_main":
+            try:
+                old, new = text.split("|",1)
+                ok, msg = rename_main_button(old.strip(), new.strip())
+                bot.send_message(uid, msg)
+            except ValueError:
+                bot.send_message(uid, "المدخل غير صالح. الصيغة: OldName|NewName")
+            pop_pending(uid); return
         if action == "adm_del_sub":
             try:
                 main, sub = text.split("|",1)
@@ -627,7 +1547,7 @@ def all_text(m):
                     bot.send_message(uid, "الخدمة غير موجودة.")
                     pop_pending(uid); return
                 # show current values and ask which field to edit
-                bot.send_message(uid, f"الخدمة #{sid}\nالاسم: {r[1]}\nالوصف: {r[2]}\nالسعر: {r[3]}$\nأرسل: name|description|price|image|collect_fields (اختر الحقل لتعديله) أو 'all' لتعديل كل شيء.")
+                bot.send_message(uid, f"الخدمة #{sid}\nالاسم: {r[1]}\nالوصف: {r[2]}\nالسعر: {fmt_money(to_cents(r[3]))}$\nالحقول: {r[6] or '[]'}\nأرسل: name|description|price|image|collect_fields (اختر الحقل لتعديله) أو 'all' لتعديل كل شيء.")
                 pending_obj["sid"] = sid; pending_obj["step"] = 2; set_pending(uid, pending_obj); return
             if step == 2:
                 field = text.strip()
@@ -645,7 +1565,9 @@ def all_text(m):
                     bot.send_message(uid, "أرسل رابط الصورة (URL):")
                     pending_obj["step"] = 3; set_pending(uid, pending_obj); return
                 if field == "collect_fields":
-                    bot.send_message(uid, "أرسل قائمة الحقول مفصولة بفاصلة (مثال: id,username,phone) أو ارسل فارغ لتعطيلها:")
+                    bot.send_message(uid, "أرسل قائمة الحقول مفصولة بفاصلة، كل حقل بصيغة name أو name:type أو name:type:min-max أو name:choice=a/b/c\n"
+                                          "الأنواع: text, number, phone, email (مثال: player_id:number:6-12,phone:phone,server:choice=EU/US)\n"
+                                          "أو قائمة JSON لتحديد regex، أو ارسل فارغ لتعطيلها:")
                     pending_obj["step"] = 3; set_pending(uid, pending_obj); return
                 if field == "all":
                     bot.send_message(uid, "أرسل البيانات مفصولة بـ | على شكل: name|description|price|image|fields(comma-separated)")
@@ -666,14 +1588,17 @@ def all_text(m):
                 if field == "image":
                     edit_service(sid, image=text); bot.send_message(uid, "تم التعديل."); pop_pending(uid); return
                 if field == "collect_fields":
-                    fields = [s.strip() for s in text.split(",")] if text else []
-                    edit_service(sid, collect_fields=fields); bot.send_message(uid, "تم التعديل."); pop_pending(uid); return
+                    try:
+                        fields = parse_fields_spec(text)
+                    except FORM_ERRORS as e:
+                        bot.send_message(uid, f"حقول غير صالحة: {e}"); pop_pending(uid); return
+                    ok, msg = edit_service(sid, collect_fields=fields); bot.send_message(uid, "تم التعديل." if ok else msg); pop_pending(uid); return
             if step == 4:
                 try:
                     sid = pending_obj["sid"]
                     name, desc, price, image, fields = text.split("|",4)
                     price = float(price)
-                    fields_list = [s.strip() for s in fields.split(",")] if fields else []
+                    fields_list = parse_fields_spec(fields)
                     edit_service(sid, name=name.strip(), description=desc.strip(), price_usd=price, image=image.strip(), collect_fields=fields_list)
                     bot.send_message(uid, "تم التعديل الشامل.")
                 except Exception as e:
@@ -683,20 +1608,20 @@ def all_text(m):
             try:
                 parts = text.split()
                 cmd = parts[0].lower()
-                target = parts[1]; amount = float(parts[2])
+                target = int(parts[1]); cents = to_cents(parts[2]); amount = fmt_money(cents)
                 if cmd == "add":
-                    new = add_balance(target, amount)
-                    bot.send_message(uid, f"تم إضافة {amount}$ للمستخدم {target}. رصيده الآن {new}$.")
+                    new = add_balance(target, cents)
+                    bot.send_message(uid, f"تم إضافة {amount}$ للمستخدم {target}. رصيده الآن {fmt_money(new)}$.")
                     try:
-                        bot.send_message(int(target), f"💰 تم إضافة {amount}$ إلى رصيدك. رصيدك الآن {new}$.")
+                        bot.send_message(target, f"💰 تم إضافة {amount}$ إلى رصيدك. رصيدك الآن {fmt_money(new)}$.")
                     except:
                         pass
                 elif cmd == "deduct":
-                    ok,res = deduct_balance(target, amount)
+                    ok,res = deduct_balance(target, cents)
                     if ok:
-                        bot.send_message(uid, f"تم خصم {amount}$ من {target}. رصيده الآن {res}$.")
+                        bot.send_message(uid, f"تم خصم {amount}$ من {target}. رصيده الآن {fmt_money(res)}$.")
                         try:
-                            bot.send_message(int(target), f"⚠️ تم خصم {amount}$ من رصيدك. رصيدك الآن {res}$.")
+                            bot.send_message(target, f"⚠️ تم خصم {amount}$ من رصيدك. رصيدك الآن {fmt_money(res)}$.")
                         except:
                             pass
                     else:
@@ -709,17 +1634,17 @@ def all_text(m):
         if action == "adm_ban":
             try:
                 parts = text.split()
-                cmd = parts[0].lower(); target = parts[1]
+                cmd = parts[0].lower(); target = int(parts[1])
                 conn = db_conn(); cur = conn.cursor()
                 if cmd == "ban":
-                    cur.execute("UPDATE users SET banned = 1 WHERE id = ?", (str(target),))
+                    cur.execute("UPDATE users SET banned = 1 WHERE id = ?", (target,))
                     conn.commit(); bot.send_message(uid, f"تم حظر {target}")
-                    try: bot.send_message(int(target), "🚫 تم حظرك من البوت.") 
+                    try: bot.send_message(target, "🚫 تم حظرك من البوت.") 
                     except: pass
                 elif cmd == "unban":
-                    cur.execute("UPDATE users SET banned = 0 WHERE id = ?", (str(target),))
+                    cur.execute("UPDATE users SET banned = 0 WHERE id = ?", (target,))
                     conn.commit(); bot.send_message(uid, f"تم إلغاء الحظر عن {target}")
-                    try: bot.send_message(int(target), "✅ تم رفع الحظر عنك.") 
+                    try: bot.send_message(target, "✅ تم رفع الحظر عنك.") 
                     except: pass
                 else:
                     bot.send_message(uid, "استخدم ban/unban <user_id>")
@@ -733,7 +1658,7 @@ def all_text(m):
             count = 0
             for r in rows:
                 try:
-                    bot.send_message(int(r[0]), text)
+                    bot.send_message(r[0], text)
                     count += 1
                 except:
                     pass
@@ -754,41 +1679,20 @@ def all_text(m):
     # if user has pending purchase collection
     pending_obj = get_pending(uid)
     if pending_obj and pending_obj.get("action") == "purchase_collect":
-        step = pending_obj["step"]
-        fields = pending_obj["fields"]
-        collected = pending_obj["collected"]
-        # store the input for current field
-        field_name = fields[step]
-        collected[field_name] = text
-        pending_obj["collected"] = collected
-        step += 1
-        if step < len(fields):
-            pending_obj["step"] = step
-            set_pending(uid, pending_obj)
-            bot.send_message(uid, f"أرسل قيمة الحقل التالي: {fields[step]}")
-            return
-        # else done collecting
-        sid = pending_obj["sid"]; price = pending_obj["price"]
-        # deduct balance and create order
-        ok,res = deduct_balance(uid, price)
-        if not ok:
-            bot.send_message(uid, f"فشل في خصم الرصيد: {res}")
-            pop_pending(uid); return
-        oid = create_order(uid, sid, collected, price)
-        bot.send_message(uid, f"✅ تم إنشاء الطلب #{oid}. رصيدك الآن {get_balance(uid)}$")
-        bot.send_message(ADMIN_ID, f"طلب جديد #{oid} من {uid} بقيمة {price}$")
-        pop_pending(uid); return
+        if collect_field_value(uid, pending_obj, text):
+            finish_collect(uid, pending_obj)
+        return
 
     # handle simple commands from users:
     if text.startswith("/topup_ext"):
         # usage: /topup_ext 5.0
         try:
             parts = text.split()
-            amt = float(parts[1])
+            cents = to_cents(parts[1])
             # simulate external payment: add as pending TX (not implemented)
             # For demo, we immediately add to balance
-            new = add_balance(uid, amt)
-            bot.send_message(uid, f"✅ تم شحن رصيدك بمقدار {amt}$. رصيدك الآن {new}$.")
+            new = add_balance(uid, cents)
+            bot.send_message(uid, f"✅ تم شحن رصيدك بمقدار {fmt_money(cents)}$. رصيدك الآن {fmt_money(new)}$.")
             return
         except:
             bot.send_message(uid, "استخدم: /topup_ext <amount>")
@@ -802,16 +1706,22 @@ def all_text(m):
             if not r:
                 bot.send_message(uid, "الخدمة غير موجودة.")
                 return
-            price = float(r[0]); collect_fields = json.loads(r[1] or "[]")
+            price = float(r[0])
+            try:
+                collect_fields = get_service_form(sid, r[1])
+            except FORM_ERRORS:
+                bot.send_message(uid, "نموذج بيانات هذه الخدمة غير صالح. تواصل مع الإدارة.")
+                return
             if collect_fields:
                 # start collect and after collection simulate payment then create order
-                set_pending(uid, {"action":"buyext_collect","sid":sid,"price":price,"fields":collect_fields,"collected":{},"step":0})
-                bot.send_message(uid, f"أرسل قيمة الحقل التالي: {collect_fields[0]}")
+                pending_obj = {"action":"buyext_collect","sid":sid,"price":price,"fields":collect_fields,"collected":{},"step":0}
+                set_pending(uid, pending_obj)
+                prompt_field(uid, pending_obj)
                 return
             # no fields, create order and notify admin
-            oid = create_order(uid, sid, {}, price)
+            oid = create_order(uid, sid, {}, price, payment="external")
             bot.send_message(uid, f"تم إنشاء طلب خارجي #{oid}. سيتم إشعارك عند التفعيل.")
-            bot.send_message(ADMIN_ID, f"[دفع خارجي] طلب جديد #{oid} من {uid} بقيمة {price}$")
+            bot.send_message(ADMIN_ID, f"[دفع خارجي] طلب جديد #{oid} من {uid} بقيمة {fmt_money(to_cents(price))}$", reply_markup=mk_order_admin_kb(oid))
             return
         except Exception:
             bot.send_message(uid, "الصيغة: /buy_ext <service_id>")
@@ -820,19 +1730,9 @@ def all_text(m):
     # pending from buyext_collect
     pending_obj = get_pending(uid)
     if pending_obj and pending_obj.get("action") == "buyext_collect":
-        step = pending_obj["step"]; fields = pending_obj["fields"]; collected = pending_obj["collected"]
-        field_name = fields[step]; collected[field_name] = text
-        step += 1
-        if step < len(fields):
-            pending_obj["step"] = step; pending_obj["collected"] = collected; set_pending(uid, pending_obj)
-            bot.send_message(uid, f"أرسل قيمة الحقل التالي: {fields[step]}"); return
-        # done collecting: create order and simulate external payment accepted
-        sid = pending_obj["sid"]; price = pending_obj["price"]
-        oid = create_order(uid, sid, collected, price)
-        # Here we assume external payment processed; admin should verify in real integration.
-        bot.send_message(uid, f"✅ تم إنشاء الطلب الخارجي #{oid}. سيتم إكماله بعد الدفع (محاكاة).")
-        bot.send_message(ADMIN_ID, f"[دفع خارجي] طلب جديد #{oid} من {uid} بقيمة {price}$")
-        pop_pending(uid); return
+        if collect_field_value(uid, pending_obj, text):
+            finish_collect(uid, pending_obj)
+        return
 
     # fallback: send main menu
     bot.send_message(uid, "استخدم الأزرار أدناه:", reply_markup=mk_main_menu())
@@ -840,5 +1740,11 @@ def all_text(m):
 # --------------- Run ----------------
 
 if __name__ == "__main__":
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.INFO)
     print("Starting bot...")
+    start_scheduler()
+    start_handler_workers()
     bot.infinity_polling()